@@ -16,6 +16,8 @@
 
 import random
 
+import numpy as np
+
 from nemo.collections.nlp.data.data_utils.data_preprocessing import DataProcessor
 
 __all__ = ['DialogueDataProcessor']
@@ -69,13 +71,13 @@ class DialogueDataProcessor(DataProcessor):
 
         if dataset_split in ["train", "dev"]:
             n_dev = int(n_samples * (dev_proportion / 100))
-            dev_idxs = random.sample(list(range(n_samples)), n_dev)
+            dev_idxs = random.sample(range(n_samples), n_dev)
             if dataset_split == "dev":
                 idxs = dev_idxs
             else:
-                dev_idxs_set = set(dev_idxs)
-                train_idxs = [idx for idx in list(range(n_samples)) if idx not in dev_idxs_set]
-                idxs = train_idxs
+                train_mask = np.ones(n_samples, dtype=bool)
+                train_mask[dev_idxs] = False
+                idxs = np.flatnonzero(train_mask).tolist()
 
         elif dataset_split == "test":
             idxs = list(range(n_samples))
@@ -17,8 +17,25 @@ import json
 import os
 from ast import literal_eval
 
+import ijson
+import torch
+from tqdm import tqdm
+
 from nemo.collections.nlp.data.dialogue.data_processor.data_processor import DialogueDataProcessor
 from nemo.collections.nlp.data.dialogue.input_example.input_example import DialogueInputExample
+from nemo.utils import logging
+from nemo.utils.get_rank import is_global_rank_zero
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.feather as feather
+
+    HAVE_PYARROW = True
+
+except (ImportError, ModuleNotFoundError):
+
+    HAVE_PYARROW = False
 
 __all__ = ['DialogueMSMarcoDataProcessor']
 
@@ -42,15 +59,208 @@ class DialogueMSMarcoDataProcessor(DialogueDataProcessor):
         self.data_dir = data_dir
         self._tokenizer = tokenizer
         self.cfg = cfg
+        self.fieldnames = ['query', 'answers', 'wellFormedAnswers', 'query_type', 'passages']
+
+        if self.cfg.use_cache and not HAVE_PYARROW:
+            logging.warning("pyarrow was not found, MS Marco files will be streamed from json without caching")
+
+    def _get_idxs(self, dataset_split, n_samples):
+        """
+        Selects the indices of the samples of dataset_split among the n_samples of its file
+        """
+        idxs = DialogueDataProcessor.get_relevant_idxs(dataset_split, n_samples, self.cfg.dev_proportion)
+
+        if self.cfg.debug_mode:
+            idxs = idxs[:100]
+
+        return idxs
 
-    def open_json(self, filename):
+    def open_json(self, filename, dataset_split):
         """
-        Reads file into a list
+        Streams file in a single pass, only building the values of the samples of dataset_split
+        Samples are selected once all answers have been streamed, as their number is needed to select them
+        Returns the selected idxs and an iterator over their rows (one tuple of self.fieldnames values per sample)
         """
         filename = os.path.join(self.data_dir, filename)
-        with open(filename, "r", encoding="UTF-8") as f:
-            data = json.load(f)
-        return data
+        data = {fieldname: {} for fieldname in self.fieldnames}
+        idxs = None
+        keys = None
+        fieldname = None
+        column = None
+        key = None
+        builder = None
+        with open(filename, "rb") as f:
+            for prefix, event, value in ijson.parse(f):
+                if prefix == fieldname:
+                    # events of the map from sample keys to values of the current field
+                    if builder is not None:
+                        column[key] = builder.value
+                        builder = None
+                        if fieldname == 'passages':
+                            # url of passages is not used, so it is not kept in memory
+                            for passage in column[key]:
+                                passage.pop('url', None)
+                    if event == 'map_key':
+                        if column is not None and (keys is None or value in keys):
+                            key = value
+                            builder = ijson.ObjectBuilder()
+                    elif event == 'end_map' and fieldname == 'answers':
+                        idxs = self._get_idxs(dataset_split, len(column))
+                        keys = {str(i) for i in idxs}
+                        # fields streamed before answers, if any, were kept for all samples
+                        data = {name: {k: v for k, v in values.items() if k in keys} for name, values in data.items()}
+                elif builder is not None:
+                    builder.event(event, value)
+                elif prefix == '' and event == 'map_key':
+                    fieldname = value
+                    column = data.get(fieldname)
+
+        columns = [data[fieldname] for fieldname in self.fieldnames]
+        # values are popped, so that the raw fields of each sample are released once its row has been processed
+        rows = (tuple(column.pop(str(i)) for column in columns) for i in idxs)
+        return idxs, rows
+
+    @staticmethod
+    def _stream_field(filename, fieldname):
+        """
+        Streams a single field of file into a dict of its values for all samples
+        """
+        with open(filename, "rb") as f:
+            return dict(ijson.kvitems(f, fieldname))
+
+    def _load_cached(self, filename):
+        """
+        Loads file as a pyarrow Table memory-mapped from an uncompressed Arrow (feather) file, read without copies
+        On first use, global rank zero converts file into an Arrow file stored next to it, with one column per field
+        Text columns use 64-bit offsets, as the passages of the train split exceed the 2GB of 32-bit offsets
+        """
+        filename = os.path.join(self.data_dir, filename)
+        arrow_filename = os.path.splitext(filename)[0] + ".arrow"
+        if is_global_rank_zero() and not os.path.exists(arrow_filename):
+            logging.info(f"Caching {filename} into {arrow_filename}")
+            # url of passages is not used, so it is left out of the cache
+            passage_type = pa.struct([('is_selected', pa.int64()), ('passage_text', pa.large_string())])
+            schema = pa.schema(
+                [
+                    ('query', pa.large_string()),
+                    ('answers', pa.large_list(pa.large_string())),
+                    ('wellFormedAnswers', pa.large_list(pa.large_string())),
+                    ('query_type', pa.large_string()),
+                    ('passages', pa.large_list(passage_type)),
+                ]
+            )
+            columns = []
+            # one field is held as Python objects at a time, and converted into an Arrow array before the next one
+            for fieldname in self.fieldnames:
+                column = DialogueMSMarcoDataProcessor._stream_field(filename, fieldname)
+                values = (column[str(i)] for i in range(len(column)))
+                if fieldname == 'answers':
+                    # answers are read as a list of answers, of which the first one is used
+                    values = (value if isinstance(value, list) else [value] for value in values)
+                elif fieldname == 'wellFormedAnswers':
+                    # some wellFormedAnswers are stored as strings (e.g. '[]'), which cannot share a column with lists
+                    values = map(DialogueMSMarcoDataProcessor.parse_well_formed_answers, values)
+                columns.append(pa.array(values, type=schema.field(fieldname).type, size=len(column)))
+                del column, values
+            # written to a temporary file first, so that an interrupted conversion is never picked up as a cache
+            tmp_filename = arrow_filename + ".tmp"
+            feather.write_feather(pa.table(columns, schema=schema), tmp_filename, compression="uncompressed")
+            os.replace(tmp_filename, arrow_filename)
+
+        # wait until the master process writes the cache
+        if torch.distributed.is_initialized():
+            torch.distributed.barrier()
+
+        if os.path.getmtime(filename) > os.path.getmtime(arrow_filename):
+            logging.warning(
+                f"{filename} was modified after its cache {arrow_filename} was created. "
+                f"The cache may be stale, you may need to delete it so that it is created again."
+            )
+
+        return feather.read_table(arrow_filename, memory_map=True)
+
+    @staticmethod
+    def parse_well_formed_answers(well_formed_answers):
+        """
+        Parses wellFormedAnswers, which are either a list or a string representation of a list (e.g. '[]')
+        json is tried first as it is much faster than literal_eval, which compiles an AST on every call
+        """
+        if isinstance(well_formed_answers, list):
+            return well_formed_answers
+        if well_formed_answers.startswith('['):
+            try:
+                return json.loads(well_formed_answers)
+            except json.JSONDecodeError:
+                pass
+        return literal_eval(well_formed_answers)
+
+    @staticmethod
+    def parse_row(query, answers, well_formed_answers, query_type, passages):
+        """
+        Extracts utterance, answer, well formed answer, query type, selected passage and possible passages
+        from the raw fields of a sample
+        """
+        # answer need not be extracted from passage
+        # taking the first answer as the ground truth correct answer as only <1% has multiple answers
+        answer = answers[0] if isinstance(answers, list) else answers
+
+        well_formed_answers = DialogueMSMarcoDataProcessor.parse_well_formed_answers(well_formed_answers)
+        well_formed_answer = well_formed_answers[0] if well_formed_answers else None
+
+        passage = None
+        possible_passages = []
+        for candidate_passage in passages:
+            passage_text = candidate_passage["passage_text"]
+            possible_passages.append(passage_text)
+            # is_selected is stored as 0 or 1 in MS Marco
+            if passage is None and candidate_passage["is_selected"]:
+                passage = passage_text
+
+        return query, answer, well_formed_answer, query_type, passage, possible_passages
+
+    @staticmethod
+    def _select_cached_rows(table, idxs, chunk_size=10000):
+        """
+        Same as parse_row for samples idxs of the cached table, but computed column-wise with pyarrow
+        Samples are selected chunk_size at a time, and each chunk is converted and released before the next one
+        Candidate passages are never converted into Python dicts: only their passage_text is extracted
+        """
+        for start in range(0, len(idxs), chunk_size):
+            # explicit type, as an empty list would otherwise be inferred as a null array which take does not support
+            selected = table.take(pa.array(idxs[start : start + chunk_size], type=pa.int64()))
+
+            answers = pc.list_element(selected.column('answers'), 0).to_pylist()
+            well_formed_answers = [
+                well_formed_answer[0] if well_formed_answer else None
+                for well_formed_answer in selected.column('wellFormedAnswers').to_pylist()
+            ]
+
+            passages = selected.column('passages').combine_chunks()
+            candidate_passages = passages.flatten()
+            is_selected = pc.cast(candidate_passages.field('is_selected'), pa.bool_())
+            selected_parents = pc.list_parent_indices(passages).filter(is_selected).to_pylist()
+            passage_texts = candidate_passages.field('passage_text')
+            selected_texts = passage_texts.filter(is_selected).to_pylist()
+            passage = [None] * selected.num_rows
+            # reversed, so that the first selected passage of each sample is kept
+            for parent, passage_text in zip(reversed(selected_parents), reversed(selected_texts)):
+                passage[parent] = passage_text
+
+            # offsets index into the unsliced child array, while flatten() starts at the first offset
+            passage_texts = passage_texts.to_pylist()
+            offsets = passages.offsets.to_pylist()
+            possible_passages = [
+                passage_texts[begin - offsets[0] : end - offsets[0]] for begin, end in zip(offsets, offsets[1:])
+            ]
+
+            yield from zip(
+                selected.column('query').to_pylist(),
+                answers,
+                well_formed_answers,
+                selected.column('query_type').to_pylist(),
+                passage,
+                possible_passages,
+            )
 
     def get_dialog_examples(self, dataset_split: str):
         """
@@ -66,38 +276,28 @@ class DialogueMSMarcoDataProcessor(DialogueDataProcessor):
 
         dataset_split_print = {"train": "train", "dev": "train", "test": "dev"}
 
-        raw_examples = self.open_json("{}_v2.1.json".format(dataset_split_print[dataset_split]))
-
-        n_samples = len(raw_examples['answers'])
+        filename = "{}_v2.1.json".format(dataset_split_print[dataset_split])
 
-        idxs = DialogueDataProcessor.get_relevant_idxs(dataset_split, n_samples, self.cfg.dev_proportion)
+        if self.cfg.use_cache and HAVE_PYARROW:
+            table = self._load_cached(filename)
+            idxs = self._get_idxs(dataset_split, table.num_rows)
+            rows = DialogueMSMarcoDataProcessor._select_cached_rows(table, idxs)
+        else:
+            idxs, rows = self.open_json(filename, dataset_split)
+            rows = (DialogueMSMarcoDataProcessor.parse_row(*row) for row in rows)
 
-        if self.cfg.debug_mode:
-            idxs = idxs[:100]
-
-        for i in idxs:
-            utterance = raw_examples['query'][str(i)]
-            # answer need not be extracted from passage
-            # taking the first answer as the ground truth correct answer as only <1% has multiple answers
-            answer = raw_examples['answers'][str(i)]
-            answer = answer[0] if isinstance(answer, list) else answer
-
-            well_formed_answer = raw_examples['wellFormedAnswers'][str(i)]
-            well_formed_answer = (
-                well_formed_answer if isinstance(well_formed_answer, list) else literal_eval(well_formed_answer)
-            )
-            well_formed_answer = well_formed_answer[0] if well_formed_answer else None
-            query_type = raw_examples['query_type'][str(i)]
-            candidate_passages = raw_examples['passages'][str(i)]
-            passage = [
-                candidate_passage["passage_text"]
-                for candidate_passage in candidate_passages
-                if int(candidate_passage["is_selected"])
-            ]
-            passage = passage[0] if passage else None
+        # shared by all examples rather than re-created for each of them
+        possible_services = "LOCATION,NUMERIC,PERSON,DESCRIPTION,ENTITY".split(',')
 
-            possible_passages = [candidate_passage["passage_text"] for candidate_passage in candidate_passages]
+        samples = tqdm(
+            zip(idxs, rows),
+            total=len(idxs),
+            desc=f"Processing MS Marco {dataset_split} examples",
+            mininterval=1.0,
+            miniters=1000,
+        )
 
+        for i, (utterance, answer, well_formed_answer, query_type, passage, possible_passages) in samples:
             input_example = {
                 "utterance": utterance,
                 "example_id": i,
@@ -108,7 +308,7 @@ class DialogueMSMarcoDataProcessor(DialogueDataProcessor):
                     "passage": passage,
                 },
                 "possible_labels": {
-                    "service": "LOCATION,NUMERIC,PERSON,DESCRIPTION,ENTITY".split(','),
+                    "service": possible_services,
                     "passage": possible_passages,
                 },
             }
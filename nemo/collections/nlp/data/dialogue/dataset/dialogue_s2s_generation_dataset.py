@@ -13,9 +13,13 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from typing import List, Tuple
+
 import torch
+from torch.utils.data.dataloader import default_collate
 
 from nemo.collections.nlp.data.dialogue.dataset.dialogue_dataset import DialogueDataset
+from nemo.collections.nlp.data.dialogue.input_example.input_example import DialogueInputExample
 
 
 class DialogueS2SGenerationDataset(DialogueDataset):
@@ -33,14 +37,34 @@ class DialogueS2SGenerationDataset(DialogueDataset):
         self.input_label_type = self.cfg.input_field
         self.output_label_type = self.cfg.output_field
         self.tokenizer = tokenizer
+        # input_field is fixed for the dataset, so the prompt template is built once instead of per sample
+        input_template = ' '.join(part + ': {' + part + '}' for part in self.input_label_type.split('+'))
+        self._format_input = input_template.format_map
         if not isinstance(dataset_split, str):
             dataset_split = dataset_split[0]
 
-        self.features = dialogues_processor.get_dialog_examples(dataset_split)
-        self.features = self.remove_invalid_samples(self.features)
+        features = dialogues_processor.get_dialog_examples(dataset_split)
+        features = self.remove_invalid_samples(features)
 
         if self.cfg.debug_mode:
-            self.features = self.features[:16]
+            features = features[:16]
+
+        input_sentences = []
+        output_sentences = []
+        for feature in features:
+            ex = feature.data
+            if 'system_actions' in ex:
+                ex["labels"]['system_actions'] = DialogueS2SGenerationDataset.format_actions(
+                    self.cfg.prompt_template, ex['system_actions']
+                )
+            input_sentences.append(self.format_prompt(ex))
+            output_sentences.append(ex["labels"][self.output_label_type])
+
+        # all samples are tokenized once here, so that __getitem__ only needs to index tensors
+        self.all_input_ids, self.all_attn_masks = self.default_encode(input_sentences)
+        # input prompts contain the utterance and are hence unique, while outputs (e.g. answers) are often shared
+        self.all_labels, _ = self.default_encode(output_sentences, deduplicate=True)
+        self.all_labels[self.all_labels == self.tokenizer.tokenizer.pad_token_id] = -100
 
     @staticmethod
     def format_actions(prompt_template, actions):
@@ -81,38 +105,57 @@ class DialogueS2SGenerationDataset(DialogueDataset):
             actions_str.append(action_str)
         return ' '.join(actions_str)
 
-    def remove_invalid_samples(self, features):
-        valid_idxs = []
-        for i in range(len(features)):
-            for field in ['utterance', 'system_utterance', 'system_actions']:
-                if field in features[i].data:
-                    features[i].data["labels"][field] = features[i].data[field]
-            all_fields = self.input_label_type.split('+') + self.output_label_type.split('+')
-            all_fields_non_empty = True
-            for field in all_fields:
-                if not features[i].data["labels"][field]:
-                    all_fields_non_empty = False
-            if all_fields_non_empty:
-                valid_idxs.append(i)
-        return [features[i] for i in valid_idxs]
+    def remove_invalid_samples(self, features: List[DialogueInputExample]) -> List[DialogueInputExample]:
+        """
+        Removes samples for which any of the input or output fields is empty
+        """
+        all_fields: Tuple[str, ...] = tuple(self.input_label_type.split('+') + self.output_label_type.split('+'))
+        valid_features = []
+        for feature in features:
+            ex = feature.data
+            labels = ex["labels"]
+            for field in ('utterance', 'system_utterance', 'system_actions'):
+                if field in ex:
+                    labels[field] = ex[field]
+            if all(labels[field] for field in all_fields):
+                valid_features.append(feature)
+        return valid_features
 
     def __len__(self):
-        return len(self.features)
+        return len(self.all_input_ids)
 
     def get_n_tokens_in_sentence(self, sentence):
         encodings_dict = self.tokenizer.tokenizer(
             sentence, truncation=True, max_length=self.cfg.max_seq_length, padding=False, return_tensors="pt"
         )
-        output = torch.squeeze(encodings_dict['input_ids'])
-        return len(output) if len(output.size()) > 0 else 0
+        return len(encodings_dict['input_ids'][0])
 
-    def default_encode(self, sentence):
-        encodings_dict = self.tokenizer.tokenizer(
-            sentence, truncation=True, max_length=self.cfg.max_seq_length, padding="max_length", return_tensors="pt"
-        )
-        input_ids = torch.squeeze(encodings_dict['input_ids'])
-        attn_masks = torch.squeeze(encodings_dict['attention_mask'])
-        return encodings_dict, input_ids, attn_masks
+    def default_encode(self, sentences, deduplicate=False, chunk_size=10000):
+        """
+        Tokenizes a list of sentences into (n_sentences, max_seq_length) int32 input_ids and int8 attention_mask
+        Sentences are tokenized chunk_size at a time, and with deduplicate, repeats within a chunk are tokenized once
+        """
+        # token ids (and -100) fit in int32, which halves memory compared to int64; batches are cast back in collate
+        input_ids = torch.empty((len(sentences), self.cfg.max_seq_length), dtype=torch.int32)
+        attn_masks = torch.empty((len(sentences), self.cfg.max_seq_length), dtype=torch.int8)
+        for start in range(0, len(sentences), chunk_size):
+            chunk = sentences[start : start + chunk_size]
+            unique_sentences = list(dict.fromkeys(chunk)) if deduplicate else chunk
+            encodings_dict = self.tokenizer.tokenizer(
+                unique_sentences,
+                truncation=True,
+                max_length=self.cfg.max_seq_length,
+                padding="max_length",
+                return_tensors="pt",
+            )
+            chunk_input_ids, chunk_attn_masks = encodings_dict['input_ids'], encodings_dict['attention_mask']
+            if deduplicate:
+                sentence_to_idx = {sentence: idx for idx, sentence in enumerate(unique_sentences)}
+                idxs = torch.tensor([sentence_to_idx[sentence] for sentence in chunk])
+                chunk_input_ids, chunk_attn_masks = chunk_input_ids[idxs], chunk_attn_masks[idxs]
+            input_ids[start : start + len(chunk)] = chunk_input_ids
+            attn_masks[start : start + len(chunk)] = chunk_attn_masks
+        return input_ids, attn_masks
 
     def format_prompt(self, ex):
         '''
@@ -123,9 +166,7 @@ class DialogueS2SGenerationDataset(DialogueDataset):
             e.g. utterance: <utterance> # input_label_type = utterance
             e.g. passage: <passage> utterance: <utterance> # input_label_type = passage+utterance
         '''
-        parts = self.input_label_type.split('+')
-        input_sentence = ' '.join([part + ': ' + ex["labels"][part] for part in parts])
-        return input_sentence
+        return self._format_input(ex["labels"])
 
     def __getitem__(self, idx: int):
 
@@ -139,23 +180,11 @@ class DialogueS2SGenerationDataset(DialogueDataset):
             e.g. INPUT - "utterance: <utterance>" OUTPUT - "<response>" # input_label_type = utterance, output_label_type = response
             e.g. INPUT - "passage: <passage> utterance: <utterance>" OUTPUT - "<response>" # input_label_type = passage+utterance, output_label_type = response
         '''
-        ex = self.features[idx].data
-        for field in ['utterance', 'system_utterance']:
-            if field in ex:
-                ex["labels"][field] = ex[field]
-
-        if 'system_actions' in ex:
-            ex["labels"]['system_actions'] = DialogueS2SGenerationDataset.format_actions(
-                self.cfg.prompt_template, ex['system_actions']
-            )
-
-        input_sentence = self.format_prompt(ex)
-        output_sentence = ex["labels"][self.output_label_type]
-
-        _, input_ids, attn_masks = self.default_encode(input_sentence)
+        return self.all_input_ids[idx], self.all_attn_masks[idx], self.all_labels[idx]
 
-        _, labels, _ = self.default_encode(output_sentence)
-
-        labels[labels == self.tokenizer.tokenizer.pad_token_id] = -100
-
-        return input_ids, attn_masks, labels
+    def _collate_fn(self, batch):
+        """collate batch of input_ids, attn_masks and labels, casting them back to int64 as expected by the models
+        Args:
+            batch:  A list of tuples of (input_ids, attn_masks, labels).
+        """
+        return [tensor.long() for tensor in default_collate(batch)]
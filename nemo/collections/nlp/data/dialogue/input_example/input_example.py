@@ -31,6 +31,9 @@ class DialogueInputExample(object):
     }
     """
 
+    # examples are created for every sample of a dataset, so __slots__ avoids a per-instance __dict__
+    __slots__ = ['data']
+
     def __init__(self, data: dict):
         self.data = data
 
@@ -205,6 +205,7 @@ class NLPModel(ModelPT, Exportable):
                 tokenizer_model=self.register_artifact(
                     config_path='tokenizer.tokenizer_model', src=cfg.tokenizer_model
                 ),
+                use_fast=cfg.get('use_fast', False),
             )
 
         if vocab_file is None:
@@ -12,17 +12,26 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import json
+import random
+
 import pytest
 import torch
+from omegaconf import OmegaConf
 
 from nemo.collections.nlp.data.dialogue.data_processor.assistant_data_processor import DialogueAssistantDataProcessor
 from nemo.collections.nlp.data.dialogue.data_processor.data_processor import DialogueDataProcessor
+from nemo.collections.nlp.data.dialogue.data_processor.ms_marco_data_processor import (
+    HAVE_PYARROW,
+    DialogueMSMarcoDataProcessor,
+)
 from nemo.collections.nlp.data.dialogue.data_processor.sgd_data_processor import DialogueSGDDataProcessor
 from nemo.collections.nlp.data.dialogue.dataset.dialogue_gpt_classification_dataset import (
     DialogueGPTClassificationDataset,
 )
 from nemo.collections.nlp.data.dialogue.dataset.dialogue_s2s_generation_dataset import DialogueS2SGenerationDataset
 from nemo.collections.nlp.data.dialogue.dataset.dialogue_sgd_bert_dataset import DialogueSGDBERTDataset
+from nemo.collections.nlp.data.dialogue.input_example.input_example import DialogueInputExample
 from nemo.collections.nlp.metrics.dialogue_metrics import DialogueClassificationMetrics, DialogueGenerationMetrics
 from nemo.collections.nlp.models.dialogue.dialogue_nearest_neighbour_model import DialogueNearestNeighbourModel
 
@@ -164,6 +173,144 @@ def test_dialogue_data_processor_get_relevant_idxs():
     assert idxs == list(range(1000))
 
 
+@pytest.mark.unit
+def test_dialogue_ms_marco_data_processor_parse_well_formed_answers():
+    assert DialogueMSMarcoDataProcessor.parse_well_formed_answers(['It is 5 km.']) == ['It is 5 km.']
+    assert DialogueMSMarcoDataProcessor.parse_well_formed_answers('[]') == []
+    assert DialogueMSMarcoDataProcessor.parse_well_formed_answers('["It is 5 km."]') == ['It is 5 km.']
+    assert DialogueMSMarcoDataProcessor.parse_well_formed_answers("['It is 5 km.']") == ['It is 5 km.']
+
+
+@pytest.mark.unit
+def test_dialogue_ms_marco_data_processor_parse_row():
+    passages = [
+        {"is_selected": 0, "passage_text": "first"},
+        {"is_selected": 1, "passage_text": "second"},
+        {"is_selected": 1, "passage_text": "third"},
+    ]
+    row = DialogueMSMarcoDataProcessor.parse_row("query", ["answer", "other"], "[]", "NUMERIC", passages)
+    assert row == ("query", "answer", None, "NUMERIC", "second", ["first", "second", "third"])
+
+    passages = [{"is_selected": 0, "passage_text": "first"}]
+    row = DialogueMSMarcoDataProcessor.parse_row("query", ["answer"], ["well formed"], "NUMERIC", passages)
+    assert row == ("query", "answer", "well formed", "NUMERIC", None, ["first"])
+
+
+def _write_ms_marco_json(data_dir, n_samples=20, answers_first=True):
+    """
+    Writes a tiny train_v2.1.json in the MS Marco format, where samples have either
+    no selected passage, one selected passage or several selected passages
+    """
+    fieldnames = ["answers", "passages", "query", "query_type", "wellFormedAnswers"]
+    if not answers_first:
+        fieldnames = fieldnames[1:] + fieldnames[:1]
+    raw_examples = {fieldname: {} for fieldname in fieldnames}
+    for i in range(n_samples):
+        key = str(i)
+        raw_examples["query"][key] = f"query {i}"
+        raw_examples["query_type"][key] = "DESCRIPTION"
+        raw_examples["answers"][key] = [f"answer {i}", "another answer"]
+        raw_examples["wellFormedAnswers"][key] = [f"well formed answer {i}"] if i % 2 else "[]"
+        raw_examples["passages"][key] = [
+            {"is_selected": int(i % 3 != 0 and j >= i % 3), "passage_text": f"passage {i} {j}", "url": "url"}
+            for j in range(4)
+        ]
+    with open(data_dir / "train_v2.1.json", "w") as f:
+        json.dump(raw_examples, f)
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize("answers_first", [True, False])
+def test_dialogue_ms_marco_data_processor_json_examples(tmp_path, answers_first):
+    _write_ms_marco_json(tmp_path, answers_first=answers_first)
+    cfg = OmegaConf.create({"use_cache": False, "dev_proportion": 20, "debug_mode": False})
+    processor = DialogueMSMarcoDataProcessor(data_dir=str(tmp_path), tokenizer=None, cfg=cfg)
+
+    for dataset_split in ["train", "dev"]:
+        random.seed(0)
+        examples = processor.get_dialog_examples(dataset_split)
+        random.seed(0)
+        idxs = DialogueDataProcessor.get_relevant_idxs(dataset_split, 20, 20)
+        assert [example.data["example_id"] for example in examples] == idxs
+
+        for example in examples:
+            i = example.data["example_id"]
+            assert example.data["utterance"] == f"query {i}"
+            assert example.data["labels"]["response"] == f"answer {i}"
+            assert example.data["labels"]["fluent_response"] == (f"well formed answer {i}" if i % 2 else None)
+            assert example.data["labels"]["passage"] == (f"passage {i} {i % 3}" if i % 3 else None)
+            assert example.data["possible_labels"]["passage"] == [f"passage {i} {j}" for j in range(4)]
+
+
+@pytest.mark.unit
+@pytest.mark.skipif(not HAVE_PYARROW, reason="pyarrow is not installed")
+def test_dialogue_ms_marco_data_processor_json_and_cached_examples(tmp_path):
+    import pyarrow as pa
+
+    _write_ms_marco_json(tmp_path)
+
+    for dataset_split, dev_proportion in [("train", 20), ("dev", 20), ("dev", 0)]:
+        split_examples = []
+        # json, cache creation and cached paths
+        for use_cache in [False, True, True]:
+            cfg = OmegaConf.create({"use_cache": use_cache, "dev_proportion": dev_proportion, "debug_mode": False})
+            processor = DialogueMSMarcoDataProcessor(data_dir=str(tmp_path), tokenizer=None, cfg=cfg)
+            random.seed(0)
+            split_examples.append([example.data for example in processor.get_dialog_examples(dataset_split)])
+        assert split_examples[0] == split_examples[1] == split_examples[2]
+
+        if dev_proportion == 0:
+            assert split_examples[0] == []
+        else:
+            assert len(split_examples[0]) == (16 if dataset_split == "train" else 4)
+
+    # text columns use 64-bit offsets, and the unused url of passages is left out
+    table = processor._load_cached("train_v2.1.json")
+    assert table.schema.field("passages").type == pa.large_list(
+        pa.struct([("is_selected", pa.int64()), ("passage_text", pa.large_string())])
+    )
+    assert not (tmp_path / "train_v2.1.arrow.tmp").exists()
+
+    # with no dev set, the train split contains all samples
+    cfg = OmegaConf.create({"use_cache": True, "dev_proportion": 0, "debug_mode": False})
+    processor = DialogueMSMarcoDataProcessor(data_dir=str(tmp_path), tokenizer=None, cfg=cfg)
+    examples = processor.get_dialog_examples("train")
+    examples = {example.data["example_id"]: example.data for example in examples}
+    assert examples[3]["labels"]["passage"] is None
+    assert examples[3]["labels"]["fluent_response"] == "well formed answer 3"
+    assert examples[4]["labels"]["passage"] == "passage 4 1"
+    assert examples[4]["labels"]["response"] == "answer 4"
+    assert examples[4]["labels"]["fluent_response"] is None
+    assert examples[4]["possible_labels"]["passage"] == [f"passage 4 {j}" for j in range(4)]
+
+
+@pytest.mark.unit
+@pytest.mark.skipif(not HAVE_PYARROW, reason="pyarrow is not installed")
+def test_dialogue_ms_marco_data_processor_select_cached_rows_multiple_chunks(tmp_path):
+    import pyarrow as pa
+
+    _write_ms_marco_json(tmp_path)
+    with open(tmp_path / "train_v2.1.json") as f:
+        raw_examples = json.load(f)
+
+    cfg = OmegaConf.create({"use_cache": True, "dev_proportion": 0, "debug_mode": False})
+    processor = DialogueMSMarcoDataProcessor(data_dir=str(tmp_path), tokenizer=None, cfg=cfg)
+    table = processor._load_cached("train_v2.1.json")
+
+    # samples are taken across table chunk boundaries, out of order and in several selection chunks
+    table = pa.Table.from_batches(table.to_batches(max_chunksize=3))
+    assert table.column("passages").num_chunks > 1
+    idxs = [13, 2, 7, 19, 0, 8, 3]
+    rows = processor._select_cached_rows(table, idxs, chunk_size=3)
+    expected_rows = [
+        DialogueMSMarcoDataProcessor.parse_row(
+            *[raw_examples[fieldname][str(i)] for fieldname in processor.fieldnames]
+        )
+        for i in idxs
+    ]
+    assert list(rows) == expected_rows
+
+
 @pytest.mark.unit
 def test_dialogue_sgd_data_processor_convert_camelcase_to_lower():
     label = 'none'
@@ -219,6 +366,131 @@ def test_dialogue_gpt_classification_dataset_linearize_slots():
     assert formatted_actions == DialogueS2SGenerationDataset.format_actions(prompt_template, actions)
 
 
+class _StubS2STokenizer:
+    """
+    Word level tokenizer with the call signature of the HuggingFace tokenizers used by DialogueS2SGenerationDataset
+    Records the sentences of every batched call in calls
+    """
+
+    pad_token_id = 0
+
+    def __init__(self):
+        # the dataset calls the HuggingFace tokenizer wrapped by the NeMo tokenizer
+        self.tokenizer = self
+        self.vocab = {}
+        self.calls = []
+
+    def __call__(self, sentences, truncation, max_length, padding, return_tensors):
+        self.calls.append(list(sentences))
+        input_ids = []
+        attention_mask = []
+        for sentence in sentences:
+            ids = [self.vocab.setdefault(word, len(self.vocab) + 1) for word in sentence.split()][:max_length]
+            n_pads = max_length - len(ids)
+            input_ids.append(ids + [self.pad_token_id] * n_pads)
+            attention_mask.append([1] * len(ids) + [0] * n_pads)
+        return {'input_ids': torch.tensor(input_ids), 'attention_mask': torch.tensor(attention_mask)}
+
+
+class _StubS2SDialoguesProcessor:
+    def __init__(self, examples):
+        self.examples = examples
+
+    def get_dialog_examples(self, dataset_split):
+        return [DialogueInputExample(data) for data in self.examples]
+
+
+def _get_s2s_dataset(examples, tokenizer):
+    cfg = OmegaConf.create(
+        {
+            'input_field': 'passage+utterance',
+            'output_field': 'response',
+            'debug_mode': False,
+            'max_seq_length': 6,
+            'prompt_template': 'values',
+        }
+    )
+    return DialogueS2SGenerationDataset('train', _StubS2SDialoguesProcessor(examples), tokenizer, cfg)
+
+
+@pytest.mark.unit
+def test_dialogue_s2s_generation_dataset_encode():
+    responses = ['yes', 'no', 'yes', 'yes', 'maybe not', 'no', 'yes', 'no']
+    examples = [
+        {'utterance': f'question {i}', 'labels': {'passage': f'passage {i}', 'response': response}}
+        for i, response in enumerate(responses)
+    ]
+    # invalid sample with an empty passage
+    examples.insert(3, {'utterance': 'question', 'labels': {'passage': '', 'response': 'yes'}})
+    tokenizer = _StubS2STokenizer()
+    dataset = _get_s2s_dataset(examples, tokenizer)
+
+    assert len(dataset) == len(responses)
+    assert dataset.all_input_ids.dtype == torch.int32
+    assert dataset.all_attn_masks.dtype == torch.int8
+    assert dataset.all_labels.dtype == torch.int32
+
+    # unique inputs are tokenized as they are, while repeated responses are only tokenized once
+    input_sentences = [f'passage: passage {i} utterance: question {i}' for i in range(len(responses))]
+    assert tokenizer.calls == [input_sentences, ['yes', 'no', 'maybe not']]
+
+    for i, (input_sentence, response) in enumerate(zip(input_sentences, responses)):
+        expected = tokenizer(
+            [input_sentence], truncation=True, max_length=6, padding='max_length', return_tensors='pt'
+        )
+        input_ids, attn_masks, labels = dataset[i]
+        assert torch.equal(input_ids.long(), expected['input_ids'][0])
+        assert torch.equal(attn_masks.long(), expected['attention_mask'][0])
+
+        expected = tokenizer([response], truncation=True, max_length=6, padding='max_length', return_tensors='pt')
+        expected_labels = expected['input_ids'][0]
+        expected_labels[expected_labels == tokenizer.pad_token_id] = -100
+        assert torch.equal(labels.long(), expected_labels)
+        assert (labels == -100).sum() == 6 - len(response.split())
+
+    input_ids, attn_masks, labels = dataset.collate_fn([dataset[i] for i in range(3)])
+    for tensor in (input_ids, attn_masks, labels):
+        assert tensor.dtype == torch.long
+        assert tensor.shape == (3, 6)
+    assert torch.equal(labels, torch.stack([dataset[i][2] for i in range(3)]).long())
+
+
+@pytest.mark.unit
+def test_dialogue_s2s_generation_dataset_encode_in_chunks():
+    tokenizer = _StubS2STokenizer()
+    dataset = _get_s2s_dataset([], tokenizer)
+    sentences = ['yes', 'no', 'yes', 'yes', 'maybe not', 'no', 'a longer sentence than max_seq_length allows']
+    input_ids, attn_masks = dataset.default_encode(sentences)
+    tokenizer.calls = []
+    chunked_input_ids, chunked_attn_masks = dataset.default_encode(sentences, chunk_size=3)
+    assert tokenizer.calls == [sentences[:3], sentences[3:6], sentences[6:]]
+    assert torch.equal(chunked_input_ids, input_ids)
+    assert torch.equal(chunked_attn_masks, attn_masks)
+
+    tokenizer.calls = []
+    chunked_input_ids, chunked_attn_masks = dataset.default_encode(sentences, deduplicate=True, chunk_size=3)
+    # repeats are only removed within a chunk
+    assert tokenizer.calls == [['yes', 'no'], ['yes', 'maybe not', 'no'], [sentences[-1]]]
+    assert torch.equal(chunked_input_ids, input_ids)
+    assert torch.equal(chunked_attn_masks, attn_masks)
+
+
+@pytest.mark.unit
+def test_dialogue_s2s_generation_dataset_empty_split():
+    dataset = _get_s2s_dataset([], _StubS2STokenizer())
+    assert len(dataset) == 0
+    assert dataset.all_input_ids.shape == dataset.all_labels.shape == (0, 6)
+
+
+@pytest.mark.unit
+def test_dialogue_s2s_generation_dataset_format_prompt():
+    dataset = _get_s2s_dataset([], _StubS2STokenizer())
+    # braces in the fields are kept as they are, and not treated as templates
+    ex = {'labels': {'passage': 'a {passage}', 'utterance': 'an utterance', 'response': 'a response'}}
+    expected_prompt = ' '.join([part + ': ' + ex["labels"][part] for part in 'passage+utterance'.split('+')])
+    assert dataset.format_prompt(ex) == expected_prompt == 'passage: a {passage} utterance: an utterance'
+
+
 @pytest.mark.unit
 def test_dialogue_sgd_dataset_naive_tokenize():
 